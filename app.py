@@ -1,16 +1,23 @@
 import os
+import asyncio
 import time
-import json
-import base64
+import random
 import secrets
+import hashlib
 import mimetypes
+from collections import deque
+from contextlib import asynccontextmanager
+from functools import lru_cache
+from itertools import islice
 from datetime import datetime, timezone, timedelta
 from pathlib import Path
 from typing import Optional
 
-import requests
-from fastapi import FastAPI, UploadFile, File, Form, Query
-from fastapi.responses import JSONResponse, FileResponse, StreamingResponse
+import httpx
+import orjson
+import pybase64
+from fastapi import FastAPI, Request, UploadFile, File, Form, Query
+from fastapi.responses import JSONResponse, FileResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
 
@@ -23,6 +30,9 @@ WORKFLOW_ID = (os.getenv("RUNNINGHUB_WORKFLOW_ID") or "").split("?")[0]
 
 USER_NODE_ID = os.getenv("RUNNINGHUB_USER_NODE_ID", "97")
 USER_FIELD = os.getenv("RUNNINGHUB_USER_FIELD_NAME", "data")
+# "base64": inline the image for a LoadImageFromBase64 node (default).
+# "upload": upload raw bytes first and pass the returned fileName (for a LoadImage node).
+USER_INPUT_MODE = os.getenv("RUNNINGHUB_USER_INPUT_MODE", "base64").strip().lower()
 
 SWITCH_NODE_ID = os.getenv("RUNNINGHUB_SWITCH_NODE_ID", "101")
 SWITCH_FIELD = os.getenv("RUNNINGHUB_SWITCH_FIELD_NAME", "Path")
@@ -44,12 +54,80 @@ ARCHIVE_INPUT_DIR = ARCHIVE_DIR / "input"
 ARCHIVE_OUTPUT_DIR = ARCHIVE_DIR / "output"
 ARCHIVE_LOG = ARCHIVE_DIR / "archives.jsonl"
 
+# Most recent log records (oldest first), so listing doesn't rescan the whole log.
+RECENT_ARCHIVES_MAX = 500
+RECENT_ARCHIVES: deque = deque(maxlen=RECENT_ARCHIVES_MAX)
+
+# archive_id -> file path, so downloads don't glob the archive folders.
+INPUT_INDEX: dict[str, Path] = {}
+OUTPUT_INDEX: dict[str, Path] = {}
+
+# (sha256(input), productOption) -> running job. Identical requests that arrive while a
+# job is still running (e.g. a double submit) share it instead of starting another.
+# Finished jobs are not kept, so pressing Generate again re-rolls with a new seed.
+INFLIGHT_GENERATES: dict[tuple, asyncio.Task] = {}
+
 if not RUNNINGHUB_API_KEY or not WORKFLOW_ID:
     raise RuntimeError("Missing RUNNINGHUB_API_KEY or RUNNINGHUB_WORKFLOW_ID")
 
+if USER_INPUT_MODE not in ("base64", "upload"):
+    raise RuntimeError(f"RUNNINGHUB_USER_INPUT_MODE must be base64 or upload, got {USER_INPUT_MODE!r}")
+
+# Archiving (disk writes, log, indexes, cleanup, archive APIs) only runs when a token is set.
+ARCHIVE_ENABLED = bool(ARCHIVE_TOKEN)
+ARCHIVE_TOKEN_BYTES = ARCHIVE_TOKEN.encode("utf-8")
+if not ARCHIVE_ENABLED:
+    print("WARNING: ARCHIVE_TOKEN is not set; archiving is disabled and generate returns RunningHub URLs.")
+
+# Request-invariant parts of the create payload, built once at import.
+STATIC_NODES = (
+    {"nodeId": PROMPT_NODE_ID, "fieldName": PROMPT_FIELD, "fieldValue": FIXED_PROMPT},
+)
+CREATE_PAYLOAD_BASE = {
+    "apiKey": RUNNINGHUB_API_KEY,
+    "workflowId": WORKFLOW_ID,
+    "addMetadata": True,
+    "instanceType": "plus",
+    "usePersonalQueue": "true",
+}
+
 # ---------------- APP ----------------
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # One pooled client for the app's lifetime: keep-alive to RunningHub
+    # instead of a fresh TCP+TLS handshake per create/poll/download call.
+    app.state.http = httpx.AsyncClient(
+        base_url=BASE_URL,
+        timeout=httpx.Timeout(60, read=120),
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+        http2=True,
+    )
+    cleanup_task = None
+    if ARCHIVE_ENABLED:
+        # Keep the archive log open for appends; the lock serializes concurrent writers.
+        ensure_archive_dirs()
+        app.state.archive_log = ARCHIVE_LOG.open("ab")
+        app.state.archive_log_lock = asyncio.Lock()
+        RECENT_ARCHIVES.clear()
+        RECENT_ARCHIVES.extendleft(islice(iter_archive_log_reversed(), RECENT_ARCHIVES_MAX))
+        build_archive_index(INPUT_INDEX, ARCHIVE_INPUT_DIR, "_input")
+        build_archive_index(OUTPUT_INDEX, ARCHIVE_OUTPUT_DIR, "_output")
+        if ARCHIVE_RETENTION_DAYS:
+            cleanup_task = asyncio.create_task(cleanup_loop())
+    yield
+    if cleanup_task:
+        cleanup_task.cancel()
+    # Stop generate jobs whose clients are gone before closing what they use
+    jobs = list(INFLIGHT_GENERATES.values())
+    for job in jobs:
+        job.cancel()
+    await asyncio.gather(*jobs, return_exceptions=True)
+    await app.state.http.aclose()
+    if ARCHIVE_ENABLED:
+        app.state.archive_log.close()
+
+app = FastAPI(lifespan=lifespan)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],  # tighten later if needed
@@ -70,33 +148,51 @@ def healthz():
 # ---------------- Helpers ----------------
 
 def utc_stamp():
-    return datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+    # Same as strftime("%Y%m%dT%H%M%SZ"), without the format-string parser
+    n = datetime.now(timezone.utc)
+    return f"{n.year:04d}{n.month:02d}{n.day:02d}T{n.hour:02d}{n.minute:02d}{n.second:02d}Z"
 
 def random_seed() -> int:
     return secrets.randbelow(MAX_SEED + 1)
 
-def bytes_to_base64(content: bytes) -> str:
-    return base64.b64encode(content).decode("ascii")
-
-def rh_post(endpoint: str, payload: dict):
-    r = requests.post(
-        f"{BASE_URL}{endpoint}",
-        json=payload,
-        headers={"Content-Type": "application/json"},
-        timeout=60,
-    )
+def bytes_to_base64(content: bytes | bytearray) -> str:
+    return pybase64.b64encode_as_string(content)
+
+async def read_upload(upload: UploadFile, chunk_size: int = 1024 * 1024) -> bytearray:
+    """Read an upload in chunks into a buffer pre-sized from its parsed size."""
+    # Starlette sets `size` from the bytes it actually spooled, never from client headers
+    buf = bytearray(upload.size or 0)
+    n = 0
+    while True:
+        chunk = await upload.read(chunk_size)
+        if not chunk:
+            break
+        # In-place when the size was known; grows the buffer only if it wasn't.
+        buf[n:n + len(chunk)] = chunk
+        n += len(chunk)
+    del buf[n:]
+    return buf
+
+async def rh_request(client: httpx.AsyncClient, endpoint: str, **kwargs) -> httpx.Response:
+    r = await client.post(endpoint, **kwargs)
     r.raise_for_status()
+    return r
+
+async def rh_post(client: httpx.AsyncClient, endpoint: str, payload: dict):
+    r = await rh_request(client, endpoint, json=payload)
     return r.json()
 
-def create_task(node_info_list):
-    resp = rh_post("/task/openapi/create", {
-        "apiKey": RUNNINGHUB_API_KEY,
-        "workflowId": WORKFLOW_ID,
-        "nodeInfoList": node_info_list,
-        "addMetadata": True,
-        "instanceType": "plus",
-        "usePersonalQueue": "true",
-    })
+def retry_after_seconds(r: httpx.Response) -> Optional[float]:
+    # A missing, unparseable or zero Retry-After means "use our own backoff"
+    value = r.headers.get("Retry-After", "").strip()
+    try:
+        wait = float(value) if value else 0.0
+    except ValueError:
+        return None
+    return wait if wait > 0 else None
+
+async def create_task(client: httpx.AsyncClient, node_info_list):
+    resp = await rh_post(client, "/task/openapi/create", {**CREATE_PAYLOAD_BASE, "nodeInfoList": node_info_list})
     if resp.get("code") != 0:
         raise RuntimeError(f"Create error: {resp}")
 
@@ -105,11 +201,44 @@ def create_task(node_info_list):
         raise RuntimeError(f"Create succeeded but no taskId: {resp}")
     return str(task_id)
 
-def poll_outputs(task_id: str, timeout_sec: int = 300, interval_sec: int = 3):
+async def upload_image(client: httpx.AsyncClient, content: bytes, filename: str, mime: str) -> str:
+    r = await rh_request(
+        client,
+        "/task/openapi/upload",
+        data={"apiKey": RUNNINGHUB_API_KEY, "fileType": "image"},
+        files={"file": (filename, content, mime)},
+    )
+    resp = r.json()
+    if resp.get("code") != 0:
+        raise RuntimeError(f"Upload error: {resp}")
+
+    file_name = (resp.get("data") or {}).get("fileName")
+    if not file_name:
+        raise RuntimeError(f"Upload succeeded but no fileName: {resp}")
+    return file_name
+
+async def poll_outputs(
+    client: httpx.AsyncClient,
+    task_id: str,
+    timeout_sec: int = 300,
+    initial_delay: float = 1.0,
+    max_delay: float = 10.0,
+):
+    # Jittered exponential backoff: poll quickly at first, then back off,
+    # and desynchronize concurrent jobs so they don't poll in lockstep.
     start = time.time()
+    delay = initial_delay
     while time.time() - start < timeout_sec:
-        resp = rh_post("/task/openapi/outputs", {"apiKey": RUNNINGHUB_API_KEY, "taskId": task_id})
-        code = resp.get("code")
+        r = await client.post("/task/openapi/outputs", json={"apiKey": RUNNINGHUB_API_KEY, "taskId": task_id})
+
+        # Throttled or briefly unavailable: wait (Retry-After if given) and poll again
+        throttled = r.status_code in (429, 503)
+        if throttled:
+            resp, code = None, None
+        else:
+            r.raise_for_status()
+            resp = r.json()
+            code = resp.get("code")
 
         if code == 0:
             data = resp.get("data", [])
@@ -119,23 +248,46 @@ def poll_outputs(task_id: str, timeout_sec: int = 300, interval_sec: int = 3):
                 return data["outputs"]
             raise RuntimeError(f"Outputs empty: {resp}")
 
-        if code == 804:
-            time.sleep(interval_sec)
+        if throttled or code == 804:
+            wait = retry_after_seconds(r)
+            if wait is None:
+                wait = delay + random.uniform(0, delay * 0.3)
+            remaining = timeout_sec - (time.time() - start)
+            await asyncio.sleep(max(min(wait, remaining), 0))
+            delay = min(delay * 1.5, max_delay)
             continue
 
         raise RuntimeError(f"Outputs error: {resp}")
 
     raise TimeoutError("RunningHub timeout")
 
+async def download_to_file(client: httpx.AsyncClient, url: str, path: Path, chunk_size: int = 1024 * 1024) -> int:
+    """Stream a URL to `path` chunk by chunk; returns the number of bytes written."""
+    size = 0
+    async with client.stream("GET", url) as r:
+        r.raise_for_status()
+        f = await asyncio.to_thread(path.open, "wb")
+        try:
+            async for chunk in r.aiter_bytes(chunk_size):
+                await asyncio.to_thread(f.write, chunk)
+                size += len(chunk)
+        except BaseException:
+            await asyncio.to_thread(f.close)
+            path.unlink(missing_ok=True)
+            raise
+        await asyncio.to_thread(f.close)
+    return size
+
 def pick_image_url(outputs):
     first = outputs[0] if outputs else {}
     return first.get("fileUrl") or first.get("imageUrl") or first.get("url") or first.get("image_url")
 
 def require_token(token: str):
-    if not ARCHIVE_TOKEN:
+    if not ARCHIVE_ENABLED:
         # If you didn't set ARCHIVE_TOKEN, we still block listing/downloading.
         raise RuntimeError("ARCHIVE_TOKEN is not configured on server.")
-    if token != ARCHIVE_TOKEN:
+    # Constant-time comparison so response timing doesn't leak the token
+    if not secrets.compare_digest(token.encode("utf-8"), ARCHIVE_TOKEN_BYTES):
         raise RuntimeError("Invalid token.")
 
 def ensure_archive_dirs():
@@ -143,12 +295,27 @@ def ensure_archive_dirs():
     ARCHIVE_OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
     ARCHIVE_DIR.mkdir(parents=True, exist_ok=True)
 
+@lru_cache(maxsize=256)
+def _guess_ext(mime: str) -> Optional[str]:
+    return mimetypes.guess_extension(mime)
+
 def safe_ext_from_mime(mime: str) -> str:
-    ext = mimetypes.guess_extension(mime or "")
+    ext = _guess_ext(mime or "")
     if ext in (".jpg", ".jpeg", ".png", ".webp"):
         return ext
     return ".bin"
 
+def archive_id_from_name(name: str, suffix: str) -> str:
+    # Filenames are {archive_id}{suffix}{ext}, e.g. ..._task_123_input.png
+    return name.rsplit(suffix, 1)[0]
+
+def build_archive_index(index: dict, folder: Path, suffix: str):
+    index.clear()
+    with os.scandir(folder) as it:
+        for entry in it:
+            if entry.is_file():
+                index[archive_id_from_name(entry.name, suffix)] = Path(entry.path)
+
 def cleanup_old_archives():
     """Optional retention cleanup (best-effort)."""
     if not ARCHIVE_RETENTION_DAYS:
@@ -160,32 +327,184 @@ def cleanup_old_archives():
     except:
         return
 
-    cutoff = datetime.now(timezone.utc) - timedelta(days=days)
-
-    # Delete files older than cutoff based on filename timestamp prefix.
-    # Our filenames start with UTC stamp: YYYYMMDDTHHMMSSZ_...
-    for folder in [ARCHIVE_INPUT_DIR, ARCHIVE_OUTPUT_DIR]:
-        for p in folder.glob("*"):
-            try:
-                stamp = p.name.split("_", 1)[0]
-                dt = datetime.strptime(stamp, "%Y%m%dT%H%M%SZ").replace(tzinfo=timezone.utc)
-                if dt < cutoff:
-                    p.unlink(missing_ok=True)
-            except:
-                continue
+    cutoff_ts = (datetime.now(timezone.utc) - timedelta(days=days)).timestamp()
+
+    # Delete files older than cutoff based on modification time
+    # (files are written once, when the archive entry is created).
+    for folder, index, suffix in [
+        (ARCHIVE_INPUT_DIR, INPUT_INDEX, "_input"),
+        (ARCHIVE_OUTPUT_DIR, OUTPUT_INDEX, "_output"),
+    ]:
+        with os.scandir(folder) as it:
+            for entry in it:
+                try:
+                    if entry.is_file() and entry.stat().st_mtime < cutoff_ts:
+                        os.unlink(entry.path)
+                        index.pop(archive_id_from_name(entry.name, suffix), None)
+                except OSError:
+                    continue
 
     # Compact log is not handled here; leaving it as audit trail.
 
+async def cleanup_loop(interval_sec: int = 3600):
+    """Run retention cleanup periodically, off the request path."""
+    while True:
+        try:
+            await asyncio.to_thread(cleanup_old_archives)
+        except Exception as e:
+            print("ERROR cleanup_old_archives:", repr(e))
+        await asyncio.sleep(interval_sec)
+
+def parse_log_line(line: bytes) -> Optional[dict]:
+    line = line.strip()
+    if not line:
+        return None
+    try:
+        return orjson.loads(line)
+    except ValueError:
+        return None
+
+def iter_archive_log_reversed(block_size: int = 64 * 1024):
+    """Yield archive log records newest first, reading the file backwards from the end."""
+    if not ARCHIVE_LOG.exists():
+        return
+    with ARCHIVE_LOG.open("rb") as f:
+        pos = f.seek(0, os.SEEK_END)
+        head = b""
+        while pos > 0:
+            step = min(block_size, pos)
+            pos -= step
+            f.seek(pos)
+            lines = (f.read(step) + head).split(b"\n")
+            head = lines.pop(0)  # may be a partial line; completed by the next block
+            for line in reversed(lines):
+                rec = parse_log_line(line)
+                if rec is not None:
+                    yield rec
+        rec = parse_log_line(head)
+        if rec is not None:
+            yield rec
+
+def write_log_line(f, line: bytes):
+    f.write(line)
+    f.flush()
+
+async def append_archive_log(app: FastAPI, record: dict):
+    line = orjson.dumps(record) + b"\n"
+    async with app.state.archive_log_lock:
+        await asyncio.to_thread(write_log_line, app.state.archive_log, line)
+        RECENT_ARCHIVES.append(record)
+
+async def archive_generation(
+    app: FastAPI,
+    client: httpx.AsyncClient,
+    task_id: str,
+    seed_val: int,
+    opt: int,
+    input_bytes: bytearray,
+    in_mime: str,
+    output_url: str,
+) -> dict:
+    """Archive input/output on disk, log the record and return the generate response."""
+    # -------- Archive files on Render disk --------
+    ts = utc_stamp()
+    bag_label = f"bag-{opt:02d}"
+
+    in_ext = safe_ext_from_mime(in_mime)
+    input_filename = f"{ts}_{bag_label}_task_{task_id}_input{in_ext}"
+    output_filename = f"{ts}_{bag_label}_task_{task_id}_output.png"
+
+    input_path = ARCHIVE_INPUT_DIR / input_filename
+    output_path = ARCHIVE_OUTPUT_DIR / output_filename
+
+    # Download the output straight to disk so we can (a) archive it (b) serve it from our domain
+    # for reliable download. The input is written only once that succeeds, so a failed download
+    # leaves nothing behind. Disk writes run in a worker thread so a slow disk doesn't stall the event loop
+    output_size = await download_to_file(client, output_url, output_path)
+    await asyncio.to_thread(input_path.write_bytes, input_bytes)
+
+    archive_id = f"{ts}_{bag_label}_task_{task_id}"
+    INPUT_INDEX[archive_id] = input_path
+    OUTPUT_INDEX[archive_id] = output_path
+
+    # Write log entry (JSONL)
+    record = {
+        "id": archive_id,
+        "ts": ts,
+        "taskId": task_id,
+        "productOption": opt,
+        "input": {
+            "filename": input_filename,
+            "mime": in_mime,
+            "size": len(input_bytes),
+        },
+        "output": {
+            "filename": output_filename,
+            "mime": "image/png",
+            "size": output_size,
+            "runninghubUrl": output_url,
+        },
+    }
+    await append_archive_log(app, record)
+
+    # Important:
+    # Return output download URL served from OUR domain (reliable download attribute)
+    return {
+        "taskId": task_id,
+        "seed": seed_val,
+        "archiveId": archive_id,
+        "imageUrl": f"/api/archive/download/{archive_id}?token={ARCHIVE_TOKEN}&kind=output",
+        "inputDownloadUrl": f"/api/archive/download/{archive_id}?token={ARCHIVE_TOKEN}&kind=input",
+    }
+
+async def run_generation(app: FastAPI, input_bytes: bytearray, opt: int, in_mime: str, filename: str) -> dict:
+    """Submit one RunningHub job, wait for it and return the generate response."""
+    client = app.state.http
+    seed_val = random_seed()
+
+    if USER_INPUT_MODE == "upload":
+        # Send raw bytes as multipart; no base64 expansion. httpx multipart file content
+        # must be bytes/str or a file object (not bytearray), hence the one copy here.
+        user_value = await upload_image(client, bytes(input_bytes), filename, in_mime)
+    else:
+        # base64 for LoadImageFromBase64 node (raw base64 only).
+        # b64encode never emits whitespace and always pads, so no cleanup pass is needed.
+        user_value = bytes_to_base64(input_bytes)
+
+    node_info_list = [
+        *STATIC_NODES,
+        {"nodeId": USER_NODE_ID, "fieldName": USER_FIELD, "fieldValue": user_value},
+        {"nodeId": SWITCH_NODE_ID, "fieldName": SWITCH_FIELD, "fieldValue": str(opt)},
+        {"nodeId": SEED_NODE_ID, "fieldName": SEED_FIELD, "fieldValue": str(seed_val)},
+    ]
+
+    task_id = await create_task(client, node_info_list)
+    outputs = await poll_outputs(client, task_id)
+    output_url = pick_image_url(outputs)
+    if not output_url:
+        raise RuntimeError(f"No imageUrl found in outputs: {outputs}")
+
+    if ARCHIVE_ENABLED:
+        return await archive_generation(
+            app, client, task_id, seed_val, opt, input_bytes, in_mime, output_url
+        )
+    # Nothing is stored locally; hand back RunningHub's own output URL
+    return {"taskId": task_id, "seed": seed_val, "imageUrl": output_url}
+
+def generation_done(key: tuple, job: asyncio.Task):
+    INFLIGHT_GENERATES.pop(key, None)
+    # Retrieve the exception here so a job nobody awaits any more still gets logged
+    if not job.cancelled() and job.exception() is not None:
+        print("ERROR generate job:", repr(job.exception()))
+
 # ---------------- API ----------------
 
 @app.post("/api/generate")
 async def generate(
+    request: Request,
     userImage: UploadFile = File(...),
     productOption: str = Form(...),  # "1" or "2"
 ):
-    ensure_archive_dirs()
-    cleanup_old_archives()
-
     # validate option
     try:
         opt = int(productOption)
@@ -195,88 +514,26 @@ async def generate(
         return JSONResponse({"error": "productOption must be >= 1."}, status_code=400)
 
     # read input image
-    input_bytes = await userImage.read()
+    input_bytes = await read_upload(userImage)
     if not input_bytes:
         return JSONResponse({"error": "Empty upload."}, status_code=400)
 
-    # base64 for LoadImageFromBase64 node (raw base64 only)
-    user_b64 = bytes_to_base64(input_bytes)
-    user_b64 = "".join(user_b64.split())
-    missing = len(user_b64) % 4
-    if missing:
-        user_b64 += "=" * (4 - missing)
+    in_mime = userImage.content_type or "application/octet-stream"
+    key = (await asyncio.to_thread(lambda: hashlib.sha256(input_bytes).digest()), opt)
 
-    seed_val = random_seed()
+    job = INFLIGHT_GENERATES.get(key)
+    if job is None:
+        job = asyncio.create_task(run_generation(
+            request.app, input_bytes, opt, in_mime, userImage.filename or "input"
+        ))
+        INFLIGHT_GENERATES[key] = job
+        job.add_done_callback(lambda t: generation_done(key, t))
 
     try:
-        node_info_list = [
-            {"nodeId": PROMPT_NODE_ID, "fieldName": PROMPT_FIELD, "fieldValue": FIXED_PROMPT},
-            {"nodeId": USER_NODE_ID, "fieldName": USER_FIELD, "fieldValue": user_b64},
-            {"nodeId": SWITCH_NODE_ID, "fieldName": SWITCH_FIELD, "fieldValue": str(opt)},
-            {"nodeId": SEED_NODE_ID, "fieldName": SEED_FIELD, "fieldValue": str(seed_val)},
-        ]
-
-        task_id = create_task(node_info_list)
-        outputs = poll_outputs(task_id)
-        output_url = pick_image_url(outputs)
-        if not output_url:
-            raise RuntimeError(f"No imageUrl found in outputs: {outputs}")
-
-        # Download output image bytes so we can (a) archive it (b) serve it from our domain for reliable download
-        out_resp = requests.get(output_url, timeout=120)
-        out_resp.raise_for_status()
-        output_bytes = out_resp.content
-
-        # -------- Archive files on Render disk --------
-        ts = utc_stamp()
-        bag_label = f"bag-{opt:02d}"
-
-        in_mime = userImage.content_type or "application/octet-stream"
-        in_ext = safe_ext_from_mime(in_mime)
-        input_filename = f"{ts}_{bag_label}_task_{task_id}_input{in_ext}"
-        output_filename = f"{ts}_{bag_label}_task_{task_id}_output.png"
-
-        input_path = ARCHIVE_INPUT_DIR / input_filename
-        output_path = ARCHIVE_OUTPUT_DIR / output_filename
-
-        input_path.write_bytes(input_bytes)
-        output_path.write_bytes(output_bytes)
-
-        archive_id = f"{ts}_{bag_label}_task_{task_id}"
-
-        # Write log entry (JSONL)
-        record = {
-            "id": archive_id,
-            "ts": ts,
-            "taskId": task_id,
-            "productOption": opt,
-            "input": {
-                "filename": input_filename,
-                "mime": in_mime,
-                "size": len(input_bytes),
-            },
-            "output": {
-                "filename": output_filename,
-                "mime": "image/png",
-                "size": len(output_bytes),
-                "runninghubUrl": output_url,
-            },
-        }
-        with ARCHIVE_LOG.open("a", encoding="utf-8") as f:
-            f.write(json.dumps(record, ensure_ascii=False) + "\n")
-
-        # Important:
-        # Return output download URL served from OUR domain (reliable download attribute)
-        return {
-            "taskId": task_id,
-            "seed": seed_val,
-            "archiveId": archive_id,
-            "imageUrl": f"/api/archive/download/{archive_id}?token={ARCHIVE_TOKEN}&kind=output",
-            "inputDownloadUrl": f"/api/archive/download/{archive_id}?token={ARCHIVE_TOKEN}&kind=input",
-        }
-
+        # Shielded so one waiter disconnecting doesn't cancel the job for the others
+        return await asyncio.shield(job)
     except Exception as e:
-        print("ERROR /api/generate:", repr(e))
+        # Already logged once per job by generation_done
         return JSONResponse({"error": str(e), "type": e.__class__.__name__}, status_code=500)
 
 # -------- Archive APIs (protected by token) --------
@@ -285,31 +542,18 @@ async def generate(
 def archive_list(
     token: str = Query(""),
     since: Optional[str] = Query(None),  # optional ISO-ish stamp filter
-    limit: int = Query(50, ge=1, le=500),
+    limit: int = Query(50, ge=1, le=RECENT_ARCHIVES_MAX),
 ):
     try:
         require_token(token)
     except Exception as e:
         return JSONResponse({"error": str(e)}, status_code=401)
 
-    if not ARCHIVE_LOG.exists():
-        return {"items": []}
-
-    items = []
-    with ARCHIVE_LOG.open("r", encoding="utf-8") as f:
-        for line in f:
-            line = line.strip()
-            if not line:
-                continue
-            try:
-                rec = json.loads(line)
-            except:
-                continue
-            if since and rec.get("ts", "") <= since:
-                continue
-            items.append(rec)
-
-    # newest last in file; return last N
+    # `limit` never exceeds the in-memory window, and the log is appended in
+    # time order, so the last `limit` matches are always within the window.
+    items = [rec for rec in list(RECENT_ARCHIVES) if not since or rec.get("ts", "") > since]
+
+    # newest last; return last N
     items = items[-limit:]
     return {"items": items}
 
@@ -324,29 +568,16 @@ def archive_download(
     except Exception as e:
         return JSONResponse({"error": str(e)}, status_code=401)
 
-    ensure_archive_dirs()
-
     if kind not in ("input", "output"):
         return JSONResponse({"error": "kind must be input or output"}, status_code=400)
 
-    # Find file by scanning the folders with prefix = archive_id
-    folder = ARCHIVE_INPUT_DIR if kind == "input" else ARCHIVE_OUTPUT_DIR
-    matches = list(folder.glob(f"{archive_id}_*"))
-    if not matches:
+    path = (INPUT_INDEX if kind == "input" else OUTPUT_INDEX).get(archive_id)
+    if not path or not path.is_file():
         return JSONResponse({"error": "File not found"}, status_code=404)
 
-    path = matches[0]
     mime = "application/octet-stream"
     if kind == "output":
         mime = "image/png"
 
-    def iterfile():
-        with path.open("rb") as f:
-            while True:
-                chunk = f.read(1024 * 1024)
-                if not chunk:
-                    break
-                yield chunk
-
-    headers = {"Content-Disposition": f'attachment; filename="{path.name}"'}
-    return StreamingResponse(iterfile(), media_type=mime, headers=headers)
+    # FileResponse sets Content-Disposition: attachment, uses sendfile where available and supports Range
+    return FileResponse(path, media_type=mime, filename=path.name)
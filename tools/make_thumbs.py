@@ -1,3 +1,5 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 from PIL import Image, ImageOps
 
@@ -23,7 +25,12 @@ def make_thumb(src: Path, dst: Path):
     canvas.alpha_composite(img, (x, y))
 
     dst.parent.mkdir(parents=True, exist_ok=True)
-    canvas.convert("RGB").save(dst, "PNG", optimize=True)
+    canvas.convert("RGB").save(dst, "WEBP", quality=85, method=4)
+
+def make_thumb_pair(src: Path) -> Path:
+    dst = OUT_DIR / f"{src.stem}.webp"
+    make_thumb(src, dst)
+    return dst
 
 def main():
     print(f"[thumbs] SRC_DIR = {SRC_DIR.resolve()}")
@@ -37,11 +44,10 @@ def main():
     print(f"[thumbs] Found {len(files)} image(s): {[p.name for p in files]}")
 
     count = 0
-    for src in files:
-        dst = OUT_DIR / f"{src.stem}.png"
-        make_thumb(src, dst)
-        print(f"[thumbs] ✅ {src.name} -> {dst.as_posix()}")
-        count += 1
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as ex:
+        for src, dst in zip(files, ex.map(make_thumb_pair, files)):
+            print(f"[thumbs] ✅ {src.name} -> {dst.as_posix()}")
+            count += 1
 
     print(f"[thumbs] Done. Generated {count} thumbnail(s).")
 